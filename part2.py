@@ -62,5 +62,126 @@ be a PNG image. Feel free to take a screenshot to get to a PNG (as long as the w
 - To assign your score, we will manually look at your graph image to see if it is correct and well-labeled. In some cases, the exact set of nodes may differ slightly between submissions, but there are some important general features/general structures that we will look for that should be present.
 """
 
+
+"""
+=== Drawing the graph from the pipeline ===
+
+Instead of drawing the graph by hand, capture_plan() runs PART_1_PIPELINE
+with part1.CAPTURE_PLAN set: the sources, general_map and general_reduce
+record their nodes in part1.PLAN, identified by what they compute and on
+which (identically partitioned) input, so shared computations are already
+a single node. draw_plan() lays the nodes out by depth and saves the image.
+
+Besides the operators, the graph has a node for each action a question
+runs on an RDD (collect, count, ...) and for sorting a collected result.
+capture_plan() turns ANALYTIC_RANGES off, so that the questions answered
+from the source range (q6-q8) draw their map and reduce pipelines instead
+of reading the load_input node directly.
+"""
+
+import part1
+import matplotlib.pyplot as plt
+import os
+
+# Fill colors of the node kinds
+NODE_COLORS = {
+    "range": "#cfe2f3", "text": "#cfe2f3", "binary": "#cfe2f3", "parallelize": "#cfe2f3", "rdd": "#cfe2f3",
+    "map": "#d9ead3", "shuffle": "#fff2cc", "repartition": "#fff2cc", "reduce": "#fce5cd", "out": "#ead1dc",
+    "sorted": "#d0e0e3", **{action: "#d0e0e3" for action in part1.PLAN_ACTIONS},
+}
+
+# The kinds of source nodes (labeled with their own label)
+SOURCES = ["range", "text", "binary", "parallelize", "rdd"]
+
+def capture_plan():
+    """
+    Run PART_1_PIPELINE with part1.CAPTURE_PLAN set and the pipelines of
+    q6-q8 enabled (without touching part1's answer file or run history).
+    output: part1.PLAN
+    """
+    settings = {"CAPTURE_PLAN": True, "ANALYTIC_RANGES": False, "ANSWER_FILE": os.devnull, "RECORD_RUNS": False}
+    previous = {name: getattr(part1, name) for name in settings}
+    part1.clear_plan()
+    try:
+        for name, value in settings.items():
+            setattr(part1, name, value)
+        part1.PART_1_PIPELINE()
+    finally:
+        for name, value in previous.items():
+            setattr(part1, name, value)
+    return part1.PLAN
+
+def node_label(node):
+    # Sources keep their own label, the other nodes are named after their questions
+    if node["op"] in SOURCES:
+        # The data and the partitioning on lines of their own, to keep the
+        # sources narrow
+        return node["label"].replace("parallelize(range", "parallelize\n(range").replace(" P=", "\nP=")
+    if node["op"] == "out":
+        return node["label"]
+    questions = node["questions"] or ["?"]
+    if len(questions) > 3:
+        questions = questions[:2] + [f"+{len(questions) - 2}"]
+    return "/".join(questions) + "-" + node["op"]
+
+def plan_layers(plan):
+    """
+    output: the node keys of plan by depth (sources first), each layer
+        ordered like the questions that use its nodes
+    """
+    depth = {}
+
+    def depth_of(key):
+        if key not in depth:
+            depth[key] = 1 + max((depth_of(k) for k in plan[key]["inputs"]), default=-1)
+        return depth[key]
+
+    order = {}
+    for key, node in plan.items():
+        for question in node["questions"]:
+            order.setdefault(question, len(order))
+    layers = [[] for _ in range(1 + max(map(depth_of, plan), default=-1))]
+    for key in plan:
+        layers[depth[key]].append(key)
+    for layer in layers:
+        layer.sort(key=lambda k: min((order[q] for q in plan[k]["questions"]), default=len(order)))
+    return layers
+
+def draw_plan(plan=None, filename="output/part2.png"):
+    """
+    Draw plan (by default, the plan of PART_1_PIPELINE) as a dataflow
+    graph and save it in filename.
+    """
+    if plan is None:
+        plan = capture_plan()
+    layers = plan_layers(plan)
+    width = max(map(len, layers), default=1)
+    position = {}
+    for row, layer in enumerate(layers):
+        for column, key in enumerate(layer):
+            # Center each layer
+            position[key] = (column + (width - len(layer)) / 2, -row)
+
+    fig, ax = plt.subplots(figsize=(max(8, 1.8 * width), max(4, 1.5 * len(layers))))
+    for key, node in plan.items():
+        for source in node["inputs"]:
+            ax.annotate(
+                "", xy=position[key], xytext=position[source],
+                arrowprops=dict(arrowstyle="-|>", color="gray", shrinkA=14, shrinkB=14),
+            )
+    for key, node in plan.items():
+        ax.text(
+            *position[key], node_label(node), ha="center", va="center", fontsize=8, wrap=True,
+            bbox=dict(boxstyle="round", facecolor=NODE_COLORS.get(node["op"], "white"), edgecolor="gray"),
+        )
+    ax.set_xlim(-0.75, width - 0.25)
+    ax.set_ylim(-len(layers) + 0.5, 0.5)
+    ax.axis("off")
+    ax.set_title("Dataflow graph of PART_1_PIPELINE")
+    fig.tight_layout()
+    fig.savefig(filename, dpi=150)
+    plt.close(fig)
+    print(f"Saved the dataflow graph ({len(plan)} nodes) to {filename}")
+
 if __name__ == '__main__':
-    print("This part has no code. Please draw a dataflow graph and save it in output/part2.png.")
+    draw_plan()
@@ -49,20 +49,57 @@ You may either delete the parts of the code that save the output file, or change
 """
 import part1, part2
 import matplotlib.pyplot as plt, time
+import argparse, contextlib, json, math, os, signal, statistics, subprocess, sys, tempfile, urllib.request
 
 NUM_RUNS = 1
 
+# Answers of the parametric pipeline go here, not to part1's answer file
+PARAMETRIC_ANSWER_FILE = "output/part1-answers-temp.txt"
+
+# Run q6, q7 and q8 through general_map and general_reduce in the
+# parametric pipeline (with part1.ANALYTIC_RANGES off), so that the sweep
+# measures the pipelines. Otherwise, their answers for a range are computed
+# directly, and the sweep measures little more than q4, q5 and the rest.
+MEASURE_PIPELINES = True
+
 def PART_1_PIPELINE_PARAMETRIC(N, P):
     """
-    TODO: Follow the same logic as PART_1_PIPELINE
+    Follows the same logic as PART_1_PIPELINE
     N = number of inputs
     P = parallelism (number of partitions)
-    (You can copy the code here), but make the following changes:
-    - load_input should use an input of size N.
-    - load_input_bigger (including q8_a and q8_b) should use an input of size N.
-    - both of these should return an RDD with level of parallelism P (number of partitions = P).
+    - load_input uses an input of size N.
+    - load_input_bigger (including q8_a and q8_b) uses an input of size N.
+    - both of these return an RDD with level of parallelism P (number of partitions = P).
+    Answers are saved to PARAMETRIC_ANSWER_FILE.
+    With MEASURE_PIPELINES, q6-q8 run their pipelines (see above).
     """
-    raise NotImplementedError
+    answer_file, analytic = part1.ANSWER_FILE, part1.ANALYTIC_RANGES
+    part1.ANSWER_FILE = PARAMETRIC_ANSWER_FILE
+    if MEASURE_PIPELINES:
+        part1.ANALYTIC_RANGES = False
+    open(PARAMETRIC_ANSWER_FILE, 'w').close()
+    try:
+        dfs = part1.share_input(part1.load_input(N, P), 6)
+        dfs = part1.fuse_scans(dfs, ["q4", "q5", "q6", "q7"])
+
+        part1.start_answers()
+        part1.log_answer("q1", part1.q1)
+        part1.log_answer("q2", part1.q2)
+        part1.log_answer("q4", part1.q4, dfs)
+        part1.log_answer("q5", part1.q5, dfs)
+        part1.log_answer("q6", part1.q6, dfs)
+        part1.log_answer("q7", part1.q7, dfs)
+        part1.log_answer("q8a", part1.q8_a, N, P)
+        part1.log_answer("q8b", part1.q8_b, N, P)
+        part1.log_answer("q11", part1.q11, dfs)
+        part1.log_answer("q14", part1.q14, dfs)
+        part1.log_answer("q16a", part1.q16_a)
+        part1.log_answer("q16b", part1.q16_b)
+        part1.log_answer("q16c", part1.q16_c)
+        part1.log_answer("q20", part1.q20)
+        part1.finish_answers("PART_1_PIPELINE_PARAMETRIC", N, P)
+    finally:
+        part1.ANSWER_FILE, part1.ANALYTIC_RANGES = answer_file, analytic
 
 """
 === Coding part 2: measuring the throughput and latency ===
@@ -139,6 +176,12 @@ class ThroughputHelper:
         # are calculated.
         self.throughputs = None
 
+        # Timing statistics for each pipeline (see measure), in BENCHMARK_MODE
+        self.stats = None
+
+        # Spark metrics for each run of each pipeline, with COLLECT_SPARK_METRICS
+        self.metrics = None
+
     def add_pipeline(self, name, size, func):
         self.names.append(name)
         self.sizes.append(size)
@@ -151,15 +194,22 @@ class ThroughputHelper:
         # Also, return the resulting list of throughputs,
         # in **number of items per second.**
         self.throughputs = []
-        for i, func in enumerate(self.pipelines):
-            start_time = time.time()
+        pipelines = instrument(self)
+        if BENCHMARK_MODE:
+            self.stats = [measure(func) for func in pipelines]
+            for size, stats in zip(self.sizes, self.stats):
+                self.throughputs.append(size / stats["median"] if stats["median"] > 0 else 0)
+            collect_metrics(self)
+            return self.throughputs
+
+        for i, func in enumerate(pipelines):
+            total_time = 0
             for n in range(NUM_RUNS):
-                func()
-            end_time = time.time()
-            total_time = end_time - start_time
+                total_time += timed(func)
             total_items = self.sizes[i] * NUM_RUNS
             throughput = (total_items/total_time) if total_time > 0 else 0
             self.throughputs.append(throughput)
+        collect_metrics(self)
         return self.throughputs
 
     def generate_plot(self, filename):
@@ -168,7 +218,13 @@ class ThroughputHelper:
         # the most sense.
         # Make sure you include a legend.
         # Save the result in the filename provided.
-        throughputs = self.compare_throughput()
+        self.compare_throughput()
+        self.plot(filename)
+
+    def plot(self, filename):
+        # Plot the throughputs measured by compare_throughput
+        # (or loaded from a sweep, see plot_sweep)
+        throughputs = self.throughputs
 
         plt.figure(figsize=(6, 6))
         bars = plt.bar(self.names, throughputs)
@@ -179,6 +235,10 @@ class ThroughputHelper:
 
         plt.savefig(filename)
         plt.show()
+        if self.stats is not None:
+            save_benchmark(filename, "throughput", self.names, self.stats, self.sizes, self.throughputs)
+        if self.metrics is not None:
+            save_metrics(filename, self.names, self.metrics)
 
 class LatencyHelper:
     def __init__(self):
@@ -197,6 +257,12 @@ class LatencyHelper:
         # are calculated.
         self.latencies = None
 
+        # Timing statistics for each pipeline (see measure), in BENCHMARK_MODE
+        self.stats = None
+
+        # Spark metrics for each run of each pipeline, with COLLECT_SPARK_METRICS
+        self.metrics = None
+
     def add_pipeline(self, name, func):
         self.names.append(name)
         self.pipelines.append(func)
@@ -207,14 +273,20 @@ class LatencyHelper:
         # Also, return the resulting list of latencies,
         # in **milliseconds.**
         self.latencies = []
-        for func in self.pipelines:
-            start_time = time.time()
+        pipelines = instrument(self)
+        if BENCHMARK_MODE:
+            self.stats = [measure(func) for func in pipelines]
+            self.latencies = [stats["median"] * 1000 for stats in self.stats]
+            collect_metrics(self)
+            return self.latencies
+
+        for func in pipelines:
+            total_time = 0
             for n in range(NUM_RUNS):
-                func()
-            end_time = time.time()
-            total_time = (end_time - start_time) * 1000 # in milliseconds
+                total_time += timed(func) * 1000 # in milliseconds
             avg_latency = total_time / NUM_RUNS
             self.latencies.append(avg_latency)
+        collect_metrics(self)
         return self.latencies
 
     def generate_plot(self, filename):
@@ -223,7 +295,13 @@ class LatencyHelper:
         # the most sense.
         # Make sure you include a legend.
         # Save the result in the filename provided.
-        latencies = self.compare_latency()
+        self.compare_latency()
+        self.plot(filename)
+
+    def plot(self, filename):
+        # Plot the latencies measured by compare_latency
+        # (or loaded from a sweep, see plot_sweep)
+        latencies = self.latencies
 
         plt.figure(figsize=(6, 6))
         plt.bar(self.names, latencies, color=['red', 'blue', 'green'])
@@ -234,9 +312,697 @@ class LatencyHelper:
         plt.legend(bars, self.names, title='Pipelines')
         plt.savefig(filename)
         plt.show()
+        if self.stats is not None:
+            save_benchmark(filename, "latency", self.names, self.stats, latencies=self.latencies)
+        if self.metrics is not None:
+            save_metrics(filename, self.names, self.metrics)
 
 # Insert code to generate plots here as needed
 
+"""
+Benchmark mode
+
+With NUM_RUNS = 1 (and no warm-up), the first run of a pipeline also pays
+for starting Spark's Python workers, and small inputs are timed with the
+noise of a single run. With BENCHMARK_MODE set, the helpers time each
+pipeline with measure() instead:
+- WARMUP_RUNS untimed runs first,
+- then timed runs (time.perf_counter) until the 95% confidence interval
+  of the mean is within TARGET_CI of the mean (at least MIN_RUNS, at most
+  MAX_RUNS runs, or MAX_SECONDS of timed runs per pipeline),
+- and the median is what gets plotted (throughput = size / median).
+
+generate_plot also saves the statistics (median, p95, mean, stddev, the
+confidence interval and every sample) next to the plot, as JSON.
+"""
+
+BENCHMARK_MODE = False
+WARMUP_RUNS = 1
+MIN_RUNS = 3
+MAX_RUNS = 30
+TARGET_CI = 0.05
+MAX_SECONDS = 120
+
+# Two-sided 95% quantiles of Student's t distribution, for 1-30 degrees of freedom
+T_95 = (
+    12.706, 4.303, 3.182, 2.776, 2.571, 2.447, 2.365, 2.306, 2.262, 2.228,
+    2.201, 2.179, 2.160, 2.145, 2.131, 2.120, 2.110, 2.101, 2.093, 2.086,
+    2.080, 2.074, 2.069, 2.064, 2.060, 2.056, 2.052, 2.048, 2.045, 2.042,
+)
+
+def confidence_interval(samples):
+    # Half-width of the 95% confidence interval of the mean of samples
+    if len(samples) < 2:
+        return math.inf
+    t = T_95[len(samples) - 2] if len(samples) - 1 <= len(T_95) else 1.96
+    return t * statistics.stdev(samples) / math.sqrt(len(samples))
+
+def percentile(samples, q):
+    # The q-th percentile of samples (0 <= q <= 100), interpolating between ranks
+    ordered = sorted(samples)
+    rank = (len(ordered) - 1) * q / 100
+    low = math.floor(rank)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (rank - low)
+
+def measure(func):
+    """
+    Time func() as described above.
+    Returns a dictionary of statistics, in seconds.
+    """
+    for _ in range(WARMUP_RUNS):
+        func()
+    samples = []
+    while len(samples) < MAX_RUNS:
+        samples.append(timed(func))
+        if len(samples) >= MIN_RUNS:
+            mean = statistics.mean(samples)
+            if confidence_interval(samples) <= TARGET_CI * mean or sum(samples) >= MAX_SECONDS:
+                break
+    return {
+        "runs": len(samples),
+        "warmup_runs": WARMUP_RUNS,
+        "median": statistics.median(samples),
+        "p95": percentile(samples, 95),
+        "mean": statistics.mean(samples),
+        "stddev": statistics.stdev(samples) if len(samples) > 1 else 0.0,
+        "ci95": confidence_interval(samples),
+        "samples": samples,
+    }
+
+def test_percentile():
+    samples = [4, 1, 3, 2, 5]
+    assert percentile(samples, 0) == 1 and percentile(samples, 100) == 5
+    assert percentile(samples, 50) == 3
+    assert percentile(samples, 95) == 4.8
+    assert percentile([1, 2], 50) == 1.5
+    assert percentile([7], 95) == 7
+
+def test_confidence_interval():
+    # One sample says nothing about the spread; identical samples have none
+    assert confidence_interval([1.0]) == math.inf
+    assert confidence_interval([2.0] * 5) == 0
+    assert math.isclose(confidence_interval([1.0, 3.0]), 12.706)
+
+def test_measure(monkeypatch):
+    # The warm-up runs (made slow here) aren't among the samples
+    monkeypatch.setattr(sys.modules[__name__], "WARMUP_RUNS", 2)
+    monkeypatch.setattr(sys.modules[__name__], "MIN_RUNS", 3)
+    monkeypatch.setattr(sys.modules[__name__], "MAX_RUNS", 4)
+    calls = []
+    def func():
+        calls.append(None)
+        if len(calls) <= 2:
+            time.sleep(0.2)
+    stats = measure(func)
+    assert stats["warmup_runs"] == 2
+    assert len(calls) == 2 + stats["runs"] == 2 + len(stats["samples"])
+    assert 3 <= stats["runs"] <= 4
+    assert max(stats["samples"]) < 0.1
+
+def save_benchmark(filename, kind, names, stats, sizes=None, throughputs=None, latencies=None):
+    """
+    Save the statistics behind the plot in filename to the same path,
+    with a .json extension.
+    """
+    pipelines = []
+    for i, name in enumerate(names):
+        entry = {"name": name, **stats[i]}
+        if sizes is not None:
+            entry["size"] = sizes[i]
+        if throughputs is not None:
+            entry["throughput"] = throughputs[i]
+        if latencies is not None:
+            entry["latency_ms"] = latencies[i]
+        pipelines.append(entry)
+    benchmark = {
+        "kind": kind,
+        "clock": "time.perf_counter",
+        "settings": {
+            "warmup_runs": WARMUP_RUNS, "min_runs": MIN_RUNS, "max_runs": MAX_RUNS,
+            "target_ci": TARGET_CI, "max_seconds": MAX_SECONDS,
+        },
+        "pipelines": pipelines,
+    }
+    with open(os.path.splitext(filename)[0] + ".json", 'w') as f:
+        json.dump(benchmark, f, indent=2)
+
+"""
+Spark metrics
+
+The total time of a run doesn't say where it went. Spark's status
+listener keeps metrics for every stage and task (the ones the Spark UI
+shows), and the UI serves them at /api/v1. With COLLECT_SPARK_METRICS set,
+the helpers note the jobs of each run of each pipeline (from Spark's
+status tracker, outside the timed part of the run), and once the timing
+is done, fetch the stages of just those jobs (collect_metrics).
+generate_plot saves them next to the plot as <plot>-metrics.json:
+for each stage, and added up over the run,
+- the number of tasks,
+- executor run time, and scheduler delay (time a task waited to start),
+- task deserialization and result serialization time, JVM GC time,
+- shuffle bytes read and written,
+- an estimate of the time spent in Python workers.
+
+Spark doesn't time the Python workers of RDD jobs. While a PySpark task
+runs, its JVM thread mostly waits for the Python worker, so the estimate
+is the run time minus the thread's CPU time and shuffle write time.
+
+This needs the Spark UI, which the "test" profile turns off (see
+part1.SPARK_PROFILES). Runs on the local engines get no stages.
+"""
+
+COLLECT_SPARK_METRICS = False
+
+# How long to wait for the listener to record the stages of a finished run
+METRICS_WAIT_SECONDS = 5
+
+def spark_job_ids():
+    # The ids of the jobs Spark has run so far, or None off the Spark engine
+    # or without a UI (the status tracker answers from memory, without the REST API)
+    if part1.current_engine() != "spark":
+        return None
+    sc = part1.get_spark().sparkContext
+    if not sc.uiWebUrl:
+        return None
+    return set(sc.statusTracker().getJobIdsForGroup())
+
+def spark_stages(stage_ids):
+    # The stages (every attempt, with their tasks) with the given ids, from the Spark UI
+    sc = part1.get_spark().sparkContext
+    stages = []
+    for stage_id in sorted(stage_ids):
+        url = f"{sc.uiWebUrl}/api/v1/applications/{sc.applicationId}/stages/{stage_id}?details=true"
+        with urllib.request.urlopen(url, timeout=30) as response:
+            stages.extend(json.load(response))
+    return stages
+
+def stage_metrics(stage):
+    # The metrics we keep for one stage (times in ms)
+    tasks = stage.get("tasks", {}).values()
+    run_ms = stage["executorRunTime"]
+    return {
+        "stage": stage["stageId"],
+        "name": stage["name"],
+        "status": stage["status"],
+        "tasks": stage["numTasks"],
+        "executor_run_ms": run_ms,
+        "scheduler_delay_ms": sum(task.get("schedulerDelay", 0) for task in tasks),
+        "deserialize_ms": stage["executorDeserializeTime"],
+        "result_serialization_ms": stage["resultSerializationTime"],
+        "gc_ms": stage["jvmGcTime"],
+        "shuffle_read_bytes": stage["shuffleReadBytes"],
+        "shuffle_write_bytes": stage["shuffleWriteBytes"],
+        "python_worker_ms": max(
+            0, run_ms - stage["executorCpuTime"] // 1000000 - stage["shuffleWriteTime"] // 1000000
+        ),
+    }
+
+def run_metrics(stages):
+    # Metrics for the stages of one run, and their totals
+    stages = sorted((stage_metrics(stage) for stage in stages), key=lambda stage: stage["stage"])
+    totals = {
+        key: sum(stage[key] for stage in stages)
+        for key in stages[0] if key not in ("stage", "name", "status")
+    } if stages else {}
+    return {"stages": stages, "totals": totals}
+
+def instrumented(func, runs):
+    """
+    output: a function that runs func() and notes the Spark jobs it ran,
+        appending them to runs (collect_metrics turns them into metrics).
+        Its seconds attribute is the time of the last func() alone.
+    """
+    def run():
+        before = spark_job_ids()
+        start = time.perf_counter()
+        result = func()
+        run.seconds = time.perf_counter() - start
+        after = spark_job_ids()
+        if before is None and after is not None:
+            # The session was started by func
+            before = set()
+        runs.append(None if after is None else ("jobs", after - before))
+        return result
+    run.seconds = None
+    return run
+
+def instrument(helper):
+    # The pipelines of helper, instrumented if COLLECT_SPARK_METRICS is set
+    if not COLLECT_SPARK_METRICS:
+        helper.metrics = None
+        return helper.pipelines
+    helper.metrics = [[] for _ in helper.pipelines]
+    return [instrumented(func, runs) for func, runs in zip(helper.pipelines, helper.metrics)]
+
+def timed(func):
+    # Run func() and return how long it took, in seconds (for an
+    # instrumented pipeline, without noting its jobs)
+    start = time.perf_counter()
+    func()
+    seconds = time.perf_counter() - start
+    return getattr(func, "seconds", None) or seconds
+
+def collect_metrics(helper):
+    """
+    Replace the jobs noted by the instrumented pipelines of helper with the
+    metrics of their stages (after the timed runs, so that fetching them
+    isn't timed). Only the stages of those jobs are fetched.
+    """
+    if helper.metrics is None:
+        return
+    tracker = part1.get_spark().sparkContext.statusTracker() if any(
+        run is not None for runs in helper.metrics for run in runs
+    ) else None
+    for runs in helper.metrics:
+        for i, run in enumerate(runs):
+            if run is None:
+                continue
+            stage_ids = set()
+            for job in run[1]:
+                info = tracker.getJobInfo(job)
+                if info is not None:
+                    stage_ids.update(info.stageIds)
+
+            # The listener records the end of a stage shortly after the job returns
+            deadline = time.perf_counter() + METRICS_WAIT_SECONDS
+            while True:
+                stages = spark_stages(stage_ids)
+                if all(stage["status"] not in ("ACTIVE", "PENDING") for stage in stages):
+                    break
+                if time.perf_counter() > deadline:
+                    break
+                time.sleep(0.1)
+            # (stages that were skipped, since their shuffle output existed, never ran)
+            runs[i] = run_metrics(stage for stage in stages if stage["status"] != "SKIPPED")
+
+def save_metrics(filename, names, metrics):
+    # Save the metrics of each pipeline next to the plot in filename
+    pipelines = [{"name": name, "runs": runs} for name, runs in zip(names, metrics)]
+    with open(os.path.splitext(filename)[0] + "-metrics.json", 'w') as f:
+        json.dump({"pipelines": pipelines}, f, indent=2)
+
+def with_settings(settings, func, *args):
+    """
+    settings: a dictionary of part1 module variables (e.g. {"ENGINE": "local"})
+    output: a function of no arguments that runs func(*args) with those
+        variables temporarily set
+    """
+    def run():
+        previous = {name: getattr(part1, name) for name in settings}
+        for name, value in settings.items():
+            setattr(part1, name, value)
+        try:
+            return func(*args)
+        finally:
+            for name, value in previous.items():
+                setattr(part1, name, value)
+    return run
+
+# Input size of q8_a and q8_b when they run the pipeline (the full 100 million
+# of load_input_bigger only runs in time with part1.ANALYTIC_RANGES)
+BIGGER_N = 10_000_000
+
+def benchmark_map_side_combine(N=1_000_000, P=8, include_q8=False, filename="output/part3-combine.png"):
+    """
+    Compare the throughput of q6 and q7 (and optionally q8_a, q8_b) with
+    part1.MAP_SIDE_COMBINE turned off (general_map, then general_reduce)
+    and turned on (general_map_reduce folds each partition first).
+    The pipelines run without part1.ANALYTIC_RANGES, which would skip them,
+    and q8_a and q8_b use BIGGER_N inputs.
+    Returns a dictionary from pipeline name to throughput (items/sec).
+    """
+    rdd = part1.load_input(N, P)
+    helper = ThroughputHelper()
+    for combine, label in [(False, "two-step"), (True, "combined")]:
+        settings = {"MAP_SIDE_COMBINE": combine, "ANALYTIC_RANGES": False}
+        helper.add_pipeline(f"q6 {label}", N, with_settings(settings, part1.q6, rdd))
+        helper.add_pipeline(f"q7 {label}", N, with_settings(settings, part1.q7, rdd))
+        if include_q8:
+            helper.add_pipeline(f"q8a {label}", BIGGER_N, with_settings(settings, part1.q8_a, BIGGER_N))
+            helper.add_pipeline(f"q8b {label}", BIGGER_N, with_settings(settings, part1.q8_b, BIGGER_N))
+
+    helper.generate_plot(filename)
+    return dict(zip(helper.names, helper.throughputs))
+
+def benchmark_backends(sizes=None, levels=None, questions=("q6", "q7")):
+    """
+    Compare the throughput of each question on the RDD pipeline
+    (general_map/general_reduce), the vectorized partition arrays
+    (part1.VECTORIZED_PARTITIONS) and Arrow record batches
+    (part1.ARROW_BATCHES), for each input size and level of parallelism
+    (INPUT_SIZES and PARALLELISM_LEVELS by default).
+    q6 and q7 are measured without part1.ANALYTIC_RANGES, which would skip the scan.
+    Plots go to output/part3-backends-P.png.
+    Returns a dictionary from P to {pipeline name: throughput (items/sec)}.
+    """
+    sizes = INPUT_SIZES if sizes is None else sizes
+    levels = PARALLELISM_LEVELS if levels is None else levels
+    functions = {"q5": part1.q5, "q6": part1.q6, "q7": part1.q7}
+    backends = [
+        ("rdd", {}),
+        ("vectorized", {"VECTORIZED_PARTITIONS": True}),
+        ("arrow", {"ARROW_BATCHES": True}),
+    ]
+    results = {}
+    for P in levels:
+        helper = ThroughputHelper()
+        for N in sizes:
+            for question in questions:
+                for backend, settings in backends:
+                    settings = {"ANALYTIC_RANGES": False, **settings}
+                    run = with_settings(settings, lambda q=question, N=N: functions[q](part1.load_input(N, P)))
+                    helper.add_pipeline(f"{question} {backend} N={N}", N, run)
+        helper.generate_plot(f"output/part3-backends-{P}.png")
+        results[P] = dict(zip(helper.names, helper.throughputs))
+    return results
+
+def compare_engines(sizes, P, engines=("spark", "local")):
+    """
+    Measure PART_1_PIPELINE_PARAMETRIC(N, P) for each N in sizes on each
+    engine (see part1.ENGINE), and plot them side by side in
+    output/part3-engines-throughput-P.png and output/part3-engines-latency-P.png.
+    Returns (throughputs, latencies) as dictionaries keyed by pipeline name.
+    """
+    throughput_helper = ThroughputHelper()
+    latency_helper = LatencyHelper()
+    for engine in engines:
+        for N in sizes:
+            run = with_settings({"ENGINE": engine}, PART_1_PIPELINE_PARAMETRIC, N, P)
+            throughput_helper.add_pipeline(f"{engine} N={N}", 2 * N, run)
+            latency_helper.add_pipeline(f"{engine} N={N}", run)
+
+    throughput_helper.generate_plot(f"output/part3-engines-throughput-{P}.png")
+    latency_helper.generate_plot(f"output/part3-engines-latency-{P}.png")
+    return (
+        dict(zip(throughput_helper.names, throughput_helper.throughputs)),
+        dict(zip(latency_helper.names, latency_helper.latencies)),
+    )
+
+def _crossovers(latencies):
+    """
+    latencies: a dictionary from input size N to {engine: latency}
+    output: the largest N up to which "inprocess" is fastest, and the
+        largest N up to which "inprocess" or "local" is fastest
+        (counting from the smallest N, as in part1.choose_engine)
+    """
+    inprocess_max_n, local_max_n = 0, 0
+    inprocess_best, local_best = True, True
+    for N in sorted(latencies):
+        best = min(latencies[N], key=latencies[N].get)
+        inprocess_best = inprocess_best and best == "inprocess"
+        local_best = local_best and best in ("inprocess", "local")
+        if inprocess_best:
+            inprocess_max_n = N
+        if local_best:
+            local_max_n = N
+    return {"inprocess_max_n": inprocess_max_n, "local_max_n": local_max_n}
+
+# Settings for the calibration runs: the questions have to scan their input
+# (with ANALYTIC_RANGES or RANGE_CACHE, a range is answered without a scan,
+# in about the same time for every N and P)
+CALIBRATION_SETTINGS = {"ANALYTIC_RANGES": False, "RANGE_CACHE": False}
+
+def calibrate_engines(sizes=(1, 100, 10_000, 1_000_000), P=4,
+                      questions=("q4", "q5", "q6", "q7", "q8a", "q8b", "q11", "q14"),
+                      engines=("inprocess", "local", "spark")):
+    """
+    Measure the latency of each question on each engine for each input size,
+    and save the crossover points to part1.ENGINE_CALIBRATION_FILE
+    (used by part1.choose_engine when part1.ENGINE is "auto").
+    The questions run with CALIBRATION_SETTINGS, so that q6-q8 scan their input.
+    Run this again to recalibrate on a new machine.
+    Returns the calibration.
+    """
+    functions = {
+        "q4": part1.q4, "q5": part1.q5, "q6": part1.q6, "q7": part1.q7,
+        "q11": part1.q11, "q14": part1.q14,
+    }
+
+    def question_run(question, N):
+        if question == "q8a":
+            return lambda: part1.q8_a(N, P)
+        if question == "q8b":
+            return lambda: part1.q8_b(N, P)
+        return lambda: functions[question](part1.load_input(N, P))
+
+    # measured[question][N][engine] = latency (ms)
+    measured = {}
+    for question in questions:
+        measured[question] = {}
+        for N in sizes:
+            helper = LatencyHelper()
+            for engine in engines:
+                settings = {"ENGINE": engine, **CALIBRATION_SETTINGS}
+                helper.add_pipeline(engine, with_settings(settings, question_run(question, N)))
+            measured[question][N] = dict(zip(engines, helper.compare_latency()))
+
+    totals = {
+        N: {engine: sum(measured[q][N][engine] for q in questions) for engine in engines}
+        for N in sizes
+    }
+    calibration = {
+        "default": _crossovers(totals),
+        "questions": {q: _crossovers(measured[q]) for q in questions},
+        "P": P,
+        "local_workers": part1.LOCAL_WORKERS,
+        "measured_ms": measured,
+    }
+    part1.save_engine_calibration(calibration)
+    return calibration
+
+def partition_probe(engine, N, P):
+    # A function running the probe of calibrate_partitions: q7 on load_input(N, P)
+    return with_settings({"ENGINE": engine, **CALIBRATION_SETTINGS}, lambda: part1.q7(part1.load_input(N, P)))
+
+def calibrate_partitions(sizes=(10_000, 100_000, 300_000), levels=(1, 2, 4, 8), engines=("spark",)):
+    """
+    Fit the cost model part1.choose_partitions uses to pick P, from a short
+    probe run of q7 for each input size and level of parallelism on each
+    engine, and save it to part1.PARTITION_MODEL_FILE.
+    Run this again to recalibrate on a new machine.
+    Returns the models, with the samples they were fitted to.
+    """
+    models = dict(part1.load_partition_models())
+    for engine in engines:
+        cores = with_settings({"ENGINE": engine}, part1.engine_cores, engine)()
+        # Start the engine before measuring anything
+        partition_probe(engine, 100, 1)()
+        samples = []
+        for N in sizes:
+            helper = LatencyHelper()
+            for P in levels:
+                helper.add_pipeline(f"P={P}", partition_probe(engine, N, P))
+            for P, latency in zip(levels, helper.compare_latency()):
+                samples.append((N, P, cores, latency / 1000))
+        models[engine] = dict(part1.fit_partition_model(samples), cores=cores, samples=samples)
+    part1.save_partition_models(models)
+    return models
+
+def test_partition_probe():
+    # The probe scans its input, so its time grows with N
+    partition_probe("inprocess", 100, 2)()
+    times = []
+    for N in [100, 100_000]:
+        start = time.perf_counter()
+        partition_probe("inprocess", N, 2)()
+        times.append(time.perf_counter() - start)
+    assert times[1] > 10 * times[0]
+
+"""
+Running the sweep
+
+The full grid (PARALLELISM_LEVELS x INPUT_SIZES) takes a while, so
+run_sweep measures it one (N, P) cell at a time:
+- each cell runs in a fresh process (python3 part3.py --cell N P), so that
+  a crash or running out of memory only loses that cell, and no cell runs
+  on a SparkContext warmed up by the cells before it,
+- a cell that takes longer than CELL_TIMEOUT seconds is stopped,
+- every finished cell is saved to SWEEP_RESULTS_FILE right away, and a
+  restarted sweep skips the cells that are already there.
+
+plot_sweep draws the ten part3-throughput/latency plots from the saved
+results, without measuring anything again.
+"""
+
+PARALLELISM_LEVELS = [1, 2, 4, 8, 16]
+INPUT_SIZES = [1, 10, 100, 1_000, 10_000, 100_000, 1_000_000]
+
+SWEEP_RESULTS_FILE = "output/part3-sweep.json"
+CELL_TIMEOUT = 600
+
+# Set to False to run the cells in this process (faster, but not isolated)
+ISOLATE_CELLS = True
+
+def measure_cell(N, P):
+    """
+    Measure PART_1_PIPELINE_PARAMETRIC(N, P) once with LatencyHelper
+    (so NUM_RUNS, BENCHMARK_MODE and COLLECT_SPARK_METRICS apply).
+    The throughput counts 2 * N items, as described above.
+    With MEASURE_PIPELINES (the default), this includes the q6-q8 pipelines.
+    """
+    # Start the engine (for Spark, the SparkContext and its Python workers)
+    # with a trivial job before the timer starts, so that the first cells
+    # don't include the start-up in their latency
+    part1.get_context().parallelize(range(P), P).count()
+    helper = LatencyHelper()
+    helper.add_pipeline(f"N={N}", lambda: PART_1_PIPELINE_PARAMETRIC(N, P))
+    [latency] = helper.compare_latency()
+    return {
+        "N": N, "P": P, "status": "ok",
+        "latency_ms": latency,
+        "throughput": 2 * N / (latency / 1000) if latency > 0 else 0,
+        "stats": helper.stats[0] if helper.stats is not None else None,
+        "metrics": helper.metrics[0] if helper.metrics is not None else None,
+    }
+
+def run_cell(N, P):
+    # Measure one cell, in a fresh process if ISOLATE_CELLS is set
+    if not ISOLATE_CELLS:
+        return measure_cell(N, P)
+    with tempfile.TemporaryDirectory() as directory:
+        result_file = os.path.join(directory, "cell.json")
+        command = [sys.executable, os.path.abspath(__file__), "--cell", str(N), str(P), "--out", result_file]
+        if BENCHMARK_MODE:
+            command.append("--benchmark")
+        if COLLECT_SPARK_METRICS:
+            command.append("--metrics")
+        if not MEASURE_PIPELINES:
+            command.append("--analytic")
+        # In its own process group, so that a timeout also stops its JVM
+        cell = subprocess.Popen(command, start_new_session=True)
+        try:
+            returncode = cell.wait(timeout=CELL_TIMEOUT)
+        except subprocess.TimeoutExpired:
+            os.killpg(cell.pid, signal.SIGKILL)
+            cell.wait()
+            return {"N": N, "P": P, "status": "timeout"}
+        if returncode != 0 or not os.path.exists(result_file):
+            return {"N": N, "P": P, "status": "failed", "returncode": returncode}
+        with open(result_file) as f:
+            return json.load(f)
+
+def load_sweep():
+    # The saved cells, keyed by "N,P"
+    if not os.path.exists(SWEEP_RESULTS_FILE):
+        return {}
+    with open(SWEEP_RESULTS_FILE) as f:
+        return json.load(f)["cells"]
+
+def save_sweep(cells):
+    # Write to a new file first, so that an interrupted save keeps the old results
+    partial = SWEEP_RESULTS_FILE + ".partial"
+    with open(partial, 'w') as f:
+        json.dump({"cells": cells}, f, indent=2)
+    os.replace(partial, SWEEP_RESULTS_FILE)
+
+def run_sweep(sizes=None, levels=None, fresh=False):
+    """
+    Measure every (N, P) cell that isn't saved yet (or all of them, if fresh).
+    Cells that timed out or failed are tried again.
+    Returns the saved cells.
+    """
+    sizes = INPUT_SIZES if sizes is None else sizes
+    levels = PARALLELISM_LEVELS if levels is None else levels
+    cells = {} if fresh else load_sweep()
+    for P in levels:
+        for N in sizes:
+            key = f"{N},{P}"
+            if cells.get(key, {}).get("status") == "ok":
+                continue
+            print(f"Measuring N={N}, P={P}")
+            cells[key] = run_cell(N, P)
+            if cells[key]["status"] != "ok":
+                print(f"Warning: N={N}, P={P} {cells[key]['status']}")
+            save_sweep(cells)
+    return cells
+
+def test_run_sweep(monkeypatch, tmp_path):
+    # A restarted sweep only measures the cells that aren't saved as "ok"
+    monkeypatch.setattr(sys.modules[__name__], "SWEEP_RESULTS_FILE", str(tmp_path / "sweep.json"))
+    measured = []
+    def fake_cell(N, P):
+        measured.append((N, P))
+        return {"N": N, "P": P, "status": "timeout" if (N, P) == (10, 2) else "ok"}
+    monkeypatch.setattr(sys.modules[__name__], "run_cell", fake_cell)
+    cells = run_sweep([1, 10], [1, 2])
+    assert len(measured) == 4 and cells["10,2"]["status"] == "timeout"
+    assert load_sweep() == cells
+    measured.clear()
+    run_sweep([1, 10], [1, 2])
+    assert measured == [(10, 2)]
+    measured.clear()
+    run_sweep([1, 10], [1, 2], fresh=True)
+    assert len(measured) == 4
+
+def test_run_cell(monkeypatch):
+    # A cell that runs too long or fails gets a row saying so
+    popen = subprocess.Popen
+    def run(code):
+        return lambda command, **kwargs: popen([sys.executable, "-c", code], **kwargs)
+    monkeypatch.setattr(sys.modules[__name__], "ISOLATE_CELLS", True)
+    monkeypatch.setattr(sys.modules[__name__], "CELL_TIMEOUT", 0.5)
+    monkeypatch.setattr(subprocess, "Popen", run("import time; time.sleep(30)"))
+    assert run_cell(10, 2) == {"N": 10, "P": 2, "status": "timeout"}
+    monkeypatch.setattr(subprocess, "Popen", run("import sys; sys.exit(3)"))
+    assert run_cell(10, 2) == {"N": 10, "P": 2, "status": "failed", "returncode": 3}
+
+def plot_sweep(cells=None):
+    """
+    Draw output/part3-throughput-P.png and output/part3-latency-P.png for
+    each level of parallelism, from the saved cells.
+    """
+    cells = load_sweep() if cells is None else cells
+    for P in PARALLELISM_LEVELS:
+        measured = sorted(
+            (cell for cell in cells.values() if cell["P"] == P and cell["status"] == "ok"),
+            key=lambda cell: cell["N"],
+        )
+        if not measured:
+            print(f"Warning: no results for P={P} yet")
+            continue
+        throughput = ThroughputHelper()
+        latency = LatencyHelper()
+        for cell in measured:
+            throughput.add_pipeline(f"N={cell['N']}", 2 * cell["N"], None)
+            latency.add_pipeline(f"N={cell['N']}", None)
+        throughput.throughputs = [cell["throughput"] for cell in measured]
+        latency.latencies = [cell["latency_ms"] for cell in measured]
+        throughput.plot(f"output/part3-throughput-{P}.png")
+        latency.plot(f"output/part3-latency-{P}.png")
+        plt.close('all')
+
+"""
+Comparing runs
+
+Every run of PART_1_PIPELINE_PARAMETRIC (and of part1's PART_1_PIPELINE)
+is recorded in part1.LEDGER_FILE. python3 part3.py --runs lists the last
+runs, and python3 part3.py --compare BASELINE [CANDIDATE] compares them
+(see part1.compare_runs), exiting with status 1 if any question regressed.
+"""
+
+def print_runs(limit=20):
+    with contextlib.closing(part1.open_ledger()) as ledger:
+        rows = ledger.execute(
+            "SELECT id, started, pipeline, N, P, engine, revision, host, seconds FROM runs ORDER BY id DESC LIMIT ?",
+            (limit,),
+        ).fetchall()
+    print(f"{'run':>5} {'started':<19} {'pipeline':<27} {'N':>10} {'P':>4} {'engine':<9} {'revision':<14} {'host':<12} {'seconds':>8}")
+    for run, started, pipeline, N, P, engine, revision, host, seconds in reversed(rows):
+        print(f"{run:>5} {started:<19} {pipeline:<27} {str(N):>10} {str(P):>4} {engine:<9} {str(revision):<14} {host[:12]:<12} {seconds:>8.2f}")
+
+def report_regressions(baseline, candidate="latest", threshold=None):
+    # Print part1.compare_runs(baseline, candidate), and return the regressed questions
+    comparison = part1.compare_runs(baseline, candidate, threshold)
+    print(part1.format_comparison(comparison))
+    regressed = [row["question"] for row in comparison if row["regressed"]]
+    threshold = part1.REGRESSION_THRESHOLD if threshold is None else threshold
+    if regressed:
+        print(f"Regressed by more than {threshold:.0%}: {', '.join(regressed)}")
+    else:
+        print(f"No question regressed by more than {threshold:.0%}")
+    return regressed
+
 """
 === Reflection part ===
 
@@ -295,7 +1061,57 @@ Running python3 part3.py should work and should re-generate all of your plots in
 """
 
 if __name__ == '__main__':
-    print("Complete part 3. Please use the main function below to generate your plots so that they are regenerated whenever the code is run:")
-
-    print("[add code here]")
-    # TODO: add code here
+    parser = argparse.ArgumentParser(description="Measure PART_1_PIPELINE_PARAMETRIC and plot the results.")
+    parser.add_argument("--cell", nargs=2, type=int, metavar=("N", "P"),
+                        help="measure a single cell (used by run_sweep)")
+    parser.add_argument("--out", help="where --cell saves its result (JSON)")
+    parser.add_argument("--plots-only", action="store_true",
+                        help=f"only redraw the plots from {SWEEP_RESULTS_FILE}")
+    parser.add_argument("--fresh", action="store_true", help="measure every cell again")
+    parser.add_argument("--sizes", nargs="+", type=int, help="input sizes N to measure")
+    parser.add_argument("--parallelism", nargs="+", type=int, help="levels of parallelism P to measure")
+    parser.add_argument("--timeout", type=float, default=CELL_TIMEOUT, help="seconds allowed per cell")
+    parser.add_argument("--in-process", action="store_true", help="run the cells in this process")
+    parser.add_argument("--benchmark", action="store_true", help="use BENCHMARK_MODE")
+    parser.add_argument("--metrics", action="store_true", help="collect Spark metrics (COLLECT_SPARK_METRICS)")
+    parser.add_argument("--analytic", action="store_true",
+                        help="answer q6-q8 for ranges directly instead of measuring their pipelines")
+    parser.add_argument("--runs", nargs="?", type=int, const=20, metavar="COUNT",
+                        help=f"list the last runs recorded in {part1.LEDGER_FILE} and exit")
+    parser.add_argument("--compare", nargs="+", metavar="RUN",
+                        help="compare the question times of run BASELINE with CANDIDATE (default: latest); "
+                             "a run is an id, 'latest', or a git revision (all its runs)")
+    parser.add_argument("--threshold", type=float,
+                        help=f"slowdown --compare flags (default {part1.REGRESSION_THRESHOLD})")
+    parser.add_argument("--calibrate-partitions", action="store_true",
+                        help=f"fit the model that picks P (saved to {part1.PARTITION_MODEL_FILE}) and exit")
+    args = parser.parse_args()
+
+    BENCHMARK_MODE = args.benchmark
+    COLLECT_SPARK_METRICS = args.metrics
+    MEASURE_PIPELINES = not args.analytic
+    if args.runs is not None:
+        print_runs(args.runs)
+        sys.exit(0)
+    if args.compare:
+        if len(args.compare) > 2:
+            parser.error("--compare takes a BASELINE and an optional CANDIDATE")
+        sys.exit(1 if report_regressions(*args.compare, threshold=args.threshold) else 0)
+    if args.calibrate_partitions:
+        print(json.dumps(calibrate_partitions(), indent=2))
+        sys.exit(0)
+    if args.cell:
+        N, P = args.cell
+        result = measure_cell(N, P)
+        if args.out:
+            with open(args.out, 'w') as f:
+                json.dump(result, f)
+        else:
+            print(json.dumps(result))
+        sys.exit(0)
+
+    if not args.plots_only:
+        CELL_TIMEOUT = args.timeout
+        ISOLATE_CELLS = not args.in_process
+        run_sweep(args.sizes, args.parallelism, fresh=args.fresh)
+    plot_sweep()